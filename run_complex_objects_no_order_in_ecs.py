@@ -68,6 +68,18 @@ def main():
                             "name": "NUXEO_DB_PASS",
                             "value": os.environ.get("NUXEO_DB_PASS")
                         },
+                        {
+                            "name": "NUXEO_DB_READ_DSN",
+                            "value": os.environ.get("NUXEO_DB_READ_DSN", "")
+                        },
+                        {
+                            "name": "RIKOLTI_OPENSEARCH_ENDPOINT",
+                            "value": os.environ.get("RIKOLTI_OPENSEARCH_ENDPOINT", "")
+                        },
+                        {
+                            "name": "RIKOLTI_INDEX",
+                            "value": os.environ.get("RIKOLTI_INDEX", "rikolti-stg")
+                        },
                     ],
                 },
             ]
@@ -1,15 +1,25 @@
+import argparse
 import os
 
 import boto3
 
-def main():
-    command = ["python", "fix_components_with_no_order.py"]
+# scripts that write to the nuxeo database, and so need the same environment
+SCRIPTS = ["fix_components_with_no_order.py", "pipeline.py"]
+
+def main(script=SCRIPTS[0], args=()):
+    command = ["python", script, *args]
 
     # assume we're running this in the pad-dsc-admin account for now
     cluster = "nuxeo"
     subnets = ["subnet-b07689e9", "subnet-ee63cf99"] # Public subnets in the nuxeo VPC
     security_groups = ["sg-51064f34", "sg-e9460f8c"] # default security group for nuxeo VPC; nuxeo-app security group
     
+    # pass through any write throttling settings, see scripts/throttle.py
+    throttle_environment = [
+        {"name": name, "value": value}
+        for name, value in os.environ.items() if name.startswith("THROTTLE_")
+    ]
+
     ecs_client = boto3.client("ecs")
     response = ecs_client.run_task(
         cluster = cluster,
@@ -64,11 +74,15 @@ def main():
                             "name": "NUXEO_DB_PASS",
                             "value": os.environ.get("NUXEO_DB_PASS")
                         },
+                        {
+                            "name": "NUXEO_DB_READ_DSN",
+                            "value": os.environ.get("NUXEO_DB_READ_DSN", "")
+                        },
                         {
                             "name": "OUTPUT_URI",
                             "value": os.environ.get("OUTPUT_URI")
                         },
-                    ],
+                    ] + throttle_environment,
                 },
             ]
         },
@@ -110,4 +124,10 @@ def main():
     print("View python output in CloudWatch. Log group is named `nuxeo-component-ordering`.")
 
 if __name__ == '__main__':
-    (main())
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("script", nargs="?", choices=SCRIPTS, default=SCRIPTS[0],
+        help="script to run in the task (default: fix_components_with_no_order.py)")
+    parser.add_argument("args", nargs=argparse.REMAINDER,
+        help="arguments for the script, e.g. --queue-size for pipeline.py")
+    args = parser.parse_args()
+    (main(args.script, args.args))
\ No newline at end of file
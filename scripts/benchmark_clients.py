@@ -0,0 +1,98 @@
+'''
+Benchmark startup time and per-request client overhead, comparing the
+shared factory in clients.py against creating clients on every call the
+way the scripts used to.
+
+HTTP overhead is measured against a local keep-alive server so the
+numbers reflect connection setup rather than network or server time.
+
+    python benchmark_clients.py [--requests N]
+'''
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import subprocess
+import sys
+import threading
+import time
+
+import clients
+
+def time_calls(fn, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return (time.perf_counter() - start) / count
+
+def import_time(module, runs=5):
+    '''
+    Best wall time of starting a fresh interpreter and importing `module`
+    '''
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", f"import {module}"], check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = b'{"entries": []}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def report(name, before, after):
+    speedup = f"{before / after:.1f}x" if after else "-"
+    print(f"{name.ljust(34)} {before * 1000:10.3f} ms {after * 1000:10.3f} ms {speedup:>8}")
+
+def main(count):
+    print(f"{''.ljust(34)} {'before':>13} {'after':>13} {'speedup':>8}")
+
+    # interpreter startup alone, subtracted so only import time is reported
+    baseline = import_time("sys")
+    report(
+        "startup: import settings",
+        max(import_time("boto3, opensearchpy") - baseline, 0),
+        max(import_time("settings") - baseline, 0))
+
+    import requests
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    report(
+        "nuxeo GET (new vs pooled conn)",
+        time_calls(lambda: requests.get(url).raise_for_status(), count),
+        time_calls(lambda: clients.nuxeo_session().get(url).raise_for_status(), count))
+    server.shutdown()
+
+    from boto3 import Session
+    from opensearchpy import AWSV4SignerAuth
+    if clients.aws_auth():
+        report(
+            "SigV4 signer",
+            time_calls(lambda: AWSV4SignerAuth(
+                Session().get_credentials(), clients.aws_region()), count),
+            time_calls(clients.aws_auth, count))
+    else:
+        print("SigV4 signer: skipped, no AWS credentials")
+
+    report(
+        "boto3 s3 client",
+        time_calls(lambda: Session().client('s3', region_name=clients.aws_region()), max(count // 10, 1)),
+        time_calls(lambda: clients.boto3_client('s3'), count))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200,
+        help="number of calls to time for each client")
+    args = parser.parse_args()
+    main(args.requests)
+    sys.exit(0)
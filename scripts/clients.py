@@ -0,0 +1,100 @@
+'''
+Shared factory for the HTTP and AWS clients used by the scripts.
+
+boto3, botocore, opensearchpy and requests are only imported the first
+time a client that needs them is requested, so scripts that never talk to
+AWS don't pay for importing it. Everything handed out here is memoized:
+
+    aws_auth()          SigV4 signer for OpenSearch; refreshable
+                        credentials renew themselves when it signs
+    boto3_client(name)  one boto3 client per service
+    nuxeo_session()     keep-alive requests session for the Nuxeo API
+    opensearch_session() keep-alive requests session for OpenSearch
+
+Sessions are kept per thread, since requests.Session isn't guaranteed to
+be thread safe; boto3 clients and the signer are shared.
+'''
+import os
+import threading
+
+POOL_SIZE = 10
+
+_lock = threading.RLock()
+_local = threading.local()
+_aws_session = None
+_aws_auth = None
+_boto3_clients = {}
+
+def aws_region():
+    return os.environ.get("AWS_REGION", "us-west-2")
+
+def aws_session():
+    '''
+    Return the shared boto3 Session
+    '''
+    global _aws_session
+    if _aws_session is None:
+        with _lock:
+            if _aws_session is None:
+                from boto3 import Session
+                _aws_session = Session()
+    return _aws_session
+
+def aws_auth():
+    '''
+    Return a cached SigV4 signer for OpenSearch, or False if there are no
+    AWS credentials
+    '''
+    global _aws_auth
+    if _aws_auth is None:
+        with _lock:
+            if _aws_auth is None:
+                credentials = aws_session().get_credentials()
+                if not credentials:
+                    _aws_auth = False
+                else:
+                    from opensearchpy import AWSV4SignerAuth
+                    _aws_auth = AWSV4SignerAuth(credentials, aws_region())
+    return _aws_auth
+
+def boto3_client(service):
+    '''
+    Return a cached boto3 client for `service`
+    '''
+    client = _boto3_clients.get(service)
+    if client is None:
+        with _lock:
+            client = _boto3_clients.get(service)
+            if client is None:
+                client = aws_session().client(service)
+                _boto3_clients[service] = client
+    return client
+
+def pooled_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def nuxeo_session():
+    '''
+    Return this thread's keep-alive session for the Nuxeo API
+    '''
+    session = getattr(_local, 'nuxeo_session', None)
+    if session is None:
+        session = _local.nuxeo_session = pooled_session()
+    return session
+
+def opensearch_session():
+    '''
+    Return this thread's keep-alive session for OpenSearch. Requests
+    still need to be signed with `auth=aws_auth()`.
+    '''
+    session = getattr(_local, 'opensearch_session', None)
+    if session is None:
+        session = _local.opensearch_session = pooled_session()
+    return session
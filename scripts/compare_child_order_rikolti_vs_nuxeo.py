@@ -1,17 +1,25 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import hashlib
 import json
 import sys
 
-import requests
-
+import clients
+import db
+import metrics
+import nuxeo
 import settings
 
-def get_opensearch_data(collection_id):
+DEFAULT_INDICES = [settings.RIKOLTI_INDEX]
+
+@metrics.timed("opensearch.get_collection")
+def get_opensearch_data(collection_id, index=DEFAULT_INDICES[0]):
     '''
-    Query rikolti opensearch stage index for complex objects
+    Query a rikolti opensearch index for complex objects
     that belong to a particular collection
     '''
-    url = f"{settings.RIKOLTI_OPENSEARCH_ENDPOINT}/rikolti-stg/_search"
+    url = f"{settings.RIKOLTI_OPENSEARCH_ENDPOINT}/{index}/_search"
     data = {
         "query": {
             "bool": {
@@ -34,32 +42,29 @@ def get_opensearch_data(collection_id):
                 ]
             }
         },
+        "_source": [
+            "calisphere-id", "title", "children.calisphere-id", "children.title"
+        ],
         "size": 3000
     }
     headers = {"Content-Type": "application/json"}
-    r = requests.get(
+    r = clients.opensearch_session().get(
         url,
         headers=headers,
         data=json.dumps(data),
-        auth=settings.get_aws_auth()
+        auth=clients.aws_auth()
     )
     r.raise_for_status()
 
     opensearch_data = r.json()
     return opensearch_data
 
+@metrics.timed("nuxeo.get_children")
 def get_nuxeo_data(parent_id):
     '''
-    Query Nuxeo for child objects of a given parent
+    Query Nuxeo for child objects of a given parent, in order. Returns
+    every child, fetching as many pages as needed.
     '''
-    headers = {
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-            "X-NXDocumentProperties": "*",
-            "X-NXRepository": "default",
-            "X-Authentication-Token": settings.NUXEO_API_TOKEN
-        }
-
     query = (
                 "SELECT * FROM SampleCustomPicture, CustomFile, "
                 "CustomVideo, CustomAudio, CustomThreeD "
@@ -69,30 +74,63 @@ def get_nuxeo_data(parent_id):
                 "AND ecm:isTrashed = 0 "
                 "ORDER BY ecm:pos ASC"
             )
+    return list(nuxeo.search(
+        query,
+        endpoint="https://nuxeo.cdlib.org/Nuxeo/site/api/v1/search/lang/NXQL/execute",
+        auth=nuxeo.token_auth()
+    ))
 
-    request = {
-        'url': "https://nuxeo.cdlib.org/Nuxeo/site/api/v1/search/lang/NXQL/execute",
-        'headers': headers,
-        'params': {
-            'pageSize': '1000',
-            'currentPageIndex': 0,
-            'query': query
-        }
-    }
+def fingerprint(ids):
+    '''
+    md5 of the comma separated ids, matching the database fingerprint
+    '''
+    return hashlib.md5(",".join(ids).encode('utf-8')).hexdigest()
 
-    try:
-        resp = requests.get(**request)
-        resp.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        print(f"unable to fetch components from nuxeo: {request}")
-        raise(e)
+@metrics.timed("postgres.get_fingerprints")
+def get_db_fingerprints(parent_ids, cursor):
+    '''
+    Fingerprint the child order of each parent in the database in a single
+    grouped query, instead of fetching every child id
 
-    nuxeo_data = resp.json()
-    return nuxeo_data
+    Returns a dict of {parent_id: (fingerprint, child_count, ordered)}.
+    `ordered` is false if any child has a NULL or duplicate pos, in which
+    case the order the fingerprint was taken in is arbitrary.
+    '''
+    query = (
+        "SELECT parentid, md5(string_agg(id, ',' ORDER BY pos)), count(*), "
+        "count(pos) = count(*) AND count(DISTINCT pos) = count(*) "
+        "FROM hierarchy "
+        "WHERE parentid = ANY(%s) "
+        f"AND primarytype in ({db.COMPLEX_OBJECT_TYPES_SQL}) "
+        "AND (istrashed IS NULL OR istrashed = 'f') "
+        "GROUP BY parentid"
+    )
+    cursor.execute(query, (list(parent_ids),))
+    return {
+        parent_id: (md5, child_count, ordered)
+        for parent_id, md5, child_count, ordered in cursor.fetchall()
+    }
+
+def fingerprint_matches(db_fingerprint, hits):
+    '''
+    True if a parent's order in the database is well defined and the same
+    as its children in every one of `hits`
+    '''
+    if not db_fingerprint:
+        return False
+    md5, child_count, ordered = db_fingerprint
+    if not ordered:
+        return False
+    for hit in hits:
+        ids = [child['calisphere-id'] for child in hit['_source'].get('children')]
+        if (md5, child_count) != (fingerprint(ids), len(ids)):
+            return False
+    return True
 
-def get_calisphere_collections_with_complex_objects():
+@metrics.timed("opensearch.get_collections")
+def get_calisphere_collections_with_complex_objects(index=DEFAULT_INDICES[0]):
     '''
-    query the rikolti opensearch stage index for a list of collections with complex objects
+    query a rikolti opensearch index for a list of collections with complex objects
 
     Returns a list of format:
     [
@@ -103,7 +141,7 @@ def get_calisphere_collections_with_complex_objects():
 
     Where 'key' in collection ID and 'doc_count' is number of documents.
     '''
-    url = f"{settings.RIKOLTI_OPENSEARCH_ENDPOINT}/rikolti-stg/_search"
+    url = f"{settings.RIKOLTI_OPENSEARCH_ENDPOINT}/{index}/_search"
     data = {
         "query": {
             "nested": {
@@ -124,81 +162,167 @@ def get_calisphere_collections_with_complex_objects():
         "size": 0
     }
     headers = {"Content-Type": "application/json"}
-    r = requests.get(
+    r = clients.opensearch_session().get(
         url,
         headers=headers,
         data=json.dumps(data),
-        auth=settings.get_aws_auth(),
+        auth=clients.aws_auth(),
     )
     r.raise_for_status()
     response = r.json()
     return response['aggregations']['collection_ids']['buckets']
     
-def main():
+def get_collection_hits(collection_id, indices, executor):
     '''
-    Check component ordering in rikolti OpenSearch index 
-    vs the order returned by the Nuxeo API. Output a report
-    of objects where the order doesn't match.
+    Fetch a collection's complex objects from every index concurrently
 
-    This script was written because contributors noticed
-    that complex objects were not retaining their order
-    when harvested through to Calisphere. This script tries
-    to identify records in the rikolti index whose order
-    is different from what's in Nuxeo.
+    Returns a dict of {parent_id: {index: hit}}, in the order the parents
+    were first returned
+    '''
+    responses = executor.map(
+        lambda index: get_opensearch_data(collection_id, index), indices)
+    parents = {}
+    for index, opensearch_data in zip(indices, responses):
+        for hit in opensearch_data['hits']['hits']:
+            parents.setdefault(hit['_source']['calisphere-id'], {})[index] = hit
+    return parents
+
+def compare_index(hit, nuxeo_ids):
+    '''
+    Compare the children of an index hit to the Nuxeo order. Returns None
+    if the parent isn't in the index.
+    '''
+    if hit is None:
+        return None
+    opensearch_children = hit['_source'].get('children')
+    opensearch_ids = [child['calisphere-id'] for child in opensearch_children]
+    return {
+        "match": opensearch_ids == nuxeo_ids,
+        "opensearch_ids": opensearch_ids,
+        "opensearch_titles": [child['title'][0] for child in opensearch_children]
+    }
+
+def differs(comparison, indices):
+    '''
+    True if an index's order doesn't match Nuxeo, or, when several indices
+    are compared, if the parent is missing from the index
     '''
-    # get list of collections on calisphere-stage that have complex objects
-    collections = get_calisphere_collections_with_complex_objects()
+    if comparison is None:
+        return len(indices) > 1
+    return not comparison['match']
+
+def compare_collections(indices, cursor, executor):
+    '''
+    Compare every collection with complex objects in any of the indices.
+    Fingerprints are checked first if `cursor` is given.
+
+    Returns the list of mismatches and the number of collections checked
+    '''
+    # get the collections that have complex objects in any of the indices
+    collections = {}
+    for index, buckets in zip(indices, executor.map(
+            get_calisphere_collections_with_complex_objects, indices)):
+        for collection in buckets:
+            collections.setdefault(collection['key'], {})[index] = collection['doc_count']
 
     collection_check_total = 0
 
     # loop through collections
     mismatches = []
-    for collection in collections:
-
-        # skip collections with over n complex objects (for dev purposes)
-        #if collection['doc_count'] > 1:
-        #     continue
-       
-        collection_id = collection['key']
-        
-        opensearch_data = get_opensearch_data(collection_id)
+    for collection_id, doc_counts in collections.items():
+        parents = get_collection_hits(collection_id, indices, executor)
         collection_check_total += 1
 
-        print(f"checking {collection_id} ({len(opensearch_data['hits']['hits'])} complex objs)")
-        
+        counts = ", ".join(f"{doc_counts.get(index, 0)} in {index}" for index in indices)
+        print(f"checking {collection_id} ({counts} complex objs)")
+
+        db_fingerprints = {}
+        if cursor is not None:
+            db_fingerprints = get_db_fingerprints(list(parents), cursor)
+
         # loop through opensearch parent objects
-        for hit in opensearch_data['hits']['hits']:
-            parent_id = hit['_source']['calisphere-id']
-            
-            # get list of opensearch child ids
-            opensearch_children = hit['_source'].get('children')
-            opensearch_ids = [child['calisphere-id'] for child in opensearch_children]
-            
-            # get list of nuxeo child ids
-            nuxeo_data = get_nuxeo_data(parent_id)
-            nuxeo_ids = [entry['uid'] for entry in nuxeo_data['entries']]
-
-            # get info on any mismatches
-            mismatch = {}
-            if opensearch_ids != nuxeo_ids:
-                opensearch_titles = [child['title'][0] for child in opensearch_children]
-                nuxeo_titles = [entry['title'] for entry in nuxeo_data['entries']]
+        for parent_id, hits in parents.items():
+            metrics.count("parents")
+
+            # skip the nuxeo fetch if every index has the parent, and the
+            # database order is identical in all of them
+            if len(hits) == len(indices) and fingerprint_matches(
+                    db_fingerprints.get(parent_id), hits.values()):
+                metrics.count("fingerprint_matches")
+                continue
+
+            # get list of nuxeo child ids, once for all indices
+            nuxeo_entries = get_nuxeo_data(parent_id)
+            nuxeo_ids = [entry['uid'] for entry in nuxeo_entries]
+
+            comparisons = {
+                index: compare_index(hits.get(index), nuxeo_ids)
+                for index in indices
+            }
+
+            # get info on any mismatches, including a parent missing from
+            # some of the indices
+            if any(differs(c, indices) for c in comparisons.values()):
                 mismatch = {
                     "collection_id": collection_id,
                     "parent_id": parent_id,
-                    "title": hit['_source']['title'],
+                    "title": next(iter(hits.values()))['_source']['title'],
                     "nuxeo_ids": nuxeo_ids,
-                    "opensearch_ids": opensearch_ids,
-                    "nuxeo_titles": nuxeo_titles,
-                    "opensearch_titles": opensearch_titles
+                    "nuxeo_titles": [entry['title'] for entry in nuxeo_entries],
+                    "indices": comparisons
                 }
                 mismatches.append(mismatch)
+                metrics.count("mismatches")
 
                 # print some info
-                count_diff = ''
-                if len(opensearch_ids) != len(nuxeo_ids):
-                    count_diff = f" - also count diff {len(opensearch_ids)} vs {len(nuxeo_ids)}"
-                print(f"   mismatch for {parent_id}{count_diff}")
+                for index, c in comparisons.items():
+                    if c is None:
+                        print(f"   {parent_id} missing from {index}")
+                    elif not c['match']:
+                        count_diff = ''
+                        if len(c['opensearch_ids']) != len(nuxeo_ids):
+                            count_diff = f" - also count diff {len(c['opensearch_ids'])} vs {len(nuxeo_ids)}"
+                        print(f"   mismatch for {parent_id} in {index}{count_diff}")
+
+    return mismatches, collection_check_total
+
+def main(indices=DEFAULT_INDICES, use_fingerprints=False):
+    '''
+    Check component ordering in one or more rikolti OpenSearch indices
+    vs the order returned by the Nuxeo API. Output a report
+    of objects where the order doesn't match in at least one index.
+
+    Each parent's children are fetched from the Nuxeo API only once,
+    however many indices are compared, and the report has a column per
+    index so that drift between indices shows up side by side.
+
+    With `use_fingerprints`, each parent's child order is first
+    compared as an md5 fingerprint computed in the Nuxeo database,
+    and full child lists are only fetched from the Nuxeo API for
+    parents whose fingerprints differ in at least one index.
+
+    This script was written because contributors noticed
+    that complex objects were not retaining their order
+    when harvested through to Calisphere. This script tries
+    to identify records in the rikolti index whose order
+    is different from what's in Nuxeo.
+    '''
+    metrics.start()
+    conn = None
+    if use_fingerprints:
+        # autocommit, so a crawl of many hours doesn't hold a transaction
+        # open on the replica
+        conn = db.get_read_connection()
+        conn.autocommit = True
+    executor = ThreadPoolExecutor(max_workers=len(indices))
+    try:
+        mismatches, collection_check_total = compare_collections(
+            indices, conn.cursor() if conn else None, executor)
+    finally:
+        executor.shutdown()
+        if conn:
+            conn.close()
+    metrics.finish()
 
     date_string = datetime.now().strftime("%Y%m%d")
     output_file = f"./output/compare_child_order_rikolti_vs_nuxeo_{date_string}.json"
@@ -206,28 +330,30 @@ def main():
          f.write(json.dumps(mismatches))
     print(f"\nReport written to {output_file}")
 
-    # print a count of objects per collection with the ordering problem
-    with open(output_file, "r") as f:
-        mismatches = json.loads(f.read())
-    collections = [m['collection_id'] for m in mismatches]
-    count_total = 0
+    # print a count of objects per collection and index with the ordering problem
     collection_counts = {}
-    for id in collections:
-        if collection_counts.get(id):
-            collection_counts[id] = collection_counts[id] + 1
-        else:
-            collection_counts[id] = 1
-        count_total += collection_counts[id]
+    for m in mismatches:
+        counts = collection_counts.setdefault(m['collection_id'], {index: 0 for index in indices})
+        for index, c in m['indices'].items():
+            if differs(c, indices):
+                counts[index] += 1
 
     # print summary info
-    print(f"Found {count_total} mismatches for {len(collections)} collections. Checked {collection_check_total} collections total.")
-    print("\nCollection ID  Count of complex objs with ordering problem")
-    for c in collection_counts:
-        print(f"{c.ljust(14)} {collection_counts[c]}")
-
-    
+    print(f"Found {len(mismatches)} mismatches for {len(collection_counts)} collections. Checked {collection_check_total} collections total.")
+    print("\nCount of complex objs with ordering problem or missing from the index")
+    print("Collection ID  " + " ".join(index.ljust(14) for index in indices))
+    for c, counts in collection_counts.items():
+        print(c.ljust(14) + " " + " ".join(str(counts[index]).ljust(14) for index in indices))
 
 
 if __name__ == "__main__":
-     main()
-     sys.exit(0)
\ No newline at end of file
+     parser = argparse.ArgumentParser()
+     parser.add_argument("--index", dest="indices", action="append",
+         help="rikolti index to compare against Nuxeo; repeat to compare "
+              f"several indices in one pass (default: {DEFAULT_INDICES[0]})")
+     parser.add_argument("--fingerprint", action="store_true",
+         help="compare md5 fingerprints from the Nuxeo database first, "
+              "and only fetch full child lists from Nuxeo for mismatches")
+     args = parser.parse_args()
+     main(args.indices or DEFAULT_INDICES, args.fingerprint)
+     sys.exit(0)
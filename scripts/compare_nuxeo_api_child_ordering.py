@@ -1,18 +1,9 @@
 import argparse
 import sys
 
-import requests
-
+import nuxeo
 import settings
 
-nuxeo_request_headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "X-NXDocumentProperties": "*",
-        "X-NXRepository": "default",
-        "X-Authentication-Token": settings.NUXEO_API_TOKEN
-    }
-
 def run_query(where_clause, endpoint):
     query = ("Select * from document "
             f"{where_clause} "
@@ -21,19 +12,10 @@ def run_query(where_clause, endpoint):
             "AND ecm:isTrashed = 0 "
             "ORDER BY ecm:pos ASC"
     )
-    request = {
-        'url': endpoint,
-        'headers': nuxeo_request_headers,
-        'params': {
-            'query': query
-        }
-    }
-    response = requests.get(**request)
-    response.raise_for_status()
+    entries = nuxeo.search(query, endpoint=endpoint, auth=nuxeo.token_auth())
 
     print(f"\n## endpoint: `{endpoint}`")
     print(f"## where clause: `{where_clause}`")
-    entries = response.json()['entries']
     for e in entries:
         print(f"{e['uid']}, {e['title']}")
 
@@ -43,17 +25,9 @@ def get_path(id, endpoint):
         "SELECT * FROM document "
         f"WHERE ecm:uuid = '{id}'"
     )
-    request = {
-        'url': endpoint,
-        'headers': nuxeo_request_headers,
-        'params': {
-            'query': query
-        }
-    }
-    response = requests.get(**request)
-    response.raise_for_status()
-    response = response.json()
-    return response['entries'][0]['path']
+    entries = nuxeo.search(
+        query, limit=1, endpoint=endpoint, auth=nuxeo.token_auth())
+    return next(entries)['path']
 
 def main(parent_id):
     '''
@@ -1,85 +1,25 @@
-from collections import namedtuple
+import argparse
 from datetime import datetime
 import sys
 import json
-import requests
-from urllib.parse import urlparse
 from zoneinfo import ZoneInfo
 
-import boto3
-import psycopg2
+import numpy as np
 
+import clients
+import metrics
+import nuxeo
 import settings
+from ordering_integrity import analyze_snapshot, open_snapshot
+from snapshot import uuid_str
+from storage import parse_data_uri, load_object_to_s3
 
-# TODO: if we ever have to run these scripts again, put storage utils in a shared file
-DataStorage = namedtuple(
-    "DateStorage", "uri, store, bucket, path"
-)
-
-def parse_data_uri(data_uri: str):
-    data_loc = urlparse(data_uri)
-    return DataStorage(
-        data_uri, data_loc.scheme, data_loc.netloc, data_loc.path)
-
-
-def load_object_to_s3(bucket, key, content):
-    s3_client = boto3.client('s3')
-    print(f"Writing s3://{bucket}/{key}")
-    try:
-        s3_client.put_object(
-            ACL='bucket-owner-full-control',
-            Bucket=bucket,
-            Key=key,
-            Body=content)
-    except Exception as e:
-        print(f"ERROR loading to S3: {e}")
-
-    return f"s3://{bucket}/{key}"
-
-def get_complex_obj_no_pos():
+@metrics.timed("nuxeo.get_document")
+def get_nuxeo_data(id):
     '''
-    Find all complex object components (children) where pos is null.
-
-    Returns a list of results in json format.
+    Get the nuxeo document for an object. Only the top level fields
+    (path, title, type) are used, so no schemas are requested.
     '''
-    conn = psycopg2.connect(database=settings.NUXEO_DB_NAME,
-                        host=settings.NUXEO_DB_HOST,
-                        user=settings.NUXEO_DB_USER,
-                        password=settings.NUXEO_DB_PASS,
-                        port="5432")
-    
-
-    cursor = conn.cursor()
-    query = (
-        "SELECT json_agg(h) "
-        "FROM (SELECT id, parentid, pos, name, isproperty, primarytype, istrashed "
-        "FROM hierarchy "
-        "WHERE parentid in ( "
-        "   SELECT id FROM hierarchy "
-        "   WHERE primarytype in ('SampleCustomPicture', 'CustomFile', 'CustomVideo', 'CustomAudio', 'CustomThreeD') "
-        "   AND (istrashed IS NULL OR istrashed = 'f') "
-        ") "
-        "AND primarytype in ('SampleCustomPicture', 'CustomFile', 'CustomVideo', 'CustomAudio', 'CustomThreeD') "
-        "AND (istrashed IS NULL OR istrashed = 'f') "
-        "AND pos IS NULL) h;"
-    )
-    cursor.execute(query)
-    results = cursor.fetchall()
-    cursor.close()
-    conn.close()
-
-    return results[0][0]
-
-
-def get_nuxeo_data(id):
-    # get full data for object using nuxeo API
-    nuxeo_request_headers = {
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-            "X-NXDocumentProperties": "*",
-            "X-NXRepository": "default",
-        }
-
     query = (
                 "SELECT * FROM Documents "
                 f"WHERE ecm:uuid = '{id}' "
@@ -87,57 +27,108 @@ def get_nuxeo_data(id):
                 "AND ecm:mixinType != 'HiddenInNavigation' "
                 "AND ecm:isTrashed = 0 "
             )
+    return list(nuxeo.search(query, limit=1))
+
+# number of parent ids to look up in the rikolti index per query
+ATTRIBUTION_CHUNK_SIZE = 1000
+
+@metrics.timed("opensearch.get_collection_urls")
+def get_collection_urls(parent_ids, index):
+    '''
+    Look up the collection of each parent in a rikolti opensearch index
+    with a `terms` query on `calisphere-id`, fetching only `collection_url`
 
-    request = {
-        'url': u'/'.join([settings.NUXEO_API_ENDPOINT, "search/lang/NXQL/execute"]),
-        'headers': nuxeo_request_headers,
-        'params': {
-            'query': query
+    Returns a dict of {parent_id: collection_url}. Parents that aren't in
+    the index are left out.
+    '''
+    url = f"{settings.RIKOLTI_OPENSEARCH_ENDPOINT}/{index}/_search"
+    data = {
+        "query": {
+            "terms": {
+                "calisphere-id": list(parent_ids)
+            }
         },
-        'auth': (settings.NUXEO_API_USER, settings.NUXEO_API_PASS)
+        "_source": ["calisphere-id", "collection_url"],
+        "size": len(parent_ids)
+    }
+    headers = {"Content-Type": "application/json"}
+    r = clients.opensearch_session().get(
+        url,
+        headers=headers,
+        data=json.dumps(data),
+        auth=clients.aws_auth()
+    )
+    r.raise_for_status()
+    return {
+        hit['_source']['calisphere-id']: hit['_source'].get('collection_url')
+        for hit in r.json()['hits']['hits']
     }
 
-    try:
-        resp = requests.get(**request)
-        resp.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        print(f"unable to fetch components from nuxeo: {request}")
-        raise(e)
+def attribute_collections(parent_ids, index, chunk_size=ATTRIBUTION_CHUNK_SIZE):
+    '''
+    Find the Calisphere collection of each parent in a rikolti index,
+    `chunk_size` parents per query
+
+    Returns a dict of {parent_id: collection_url}
+    '''
+    parent_ids = list(parent_ids)
+    collection_urls = {}
+    for i in range(0, len(parent_ids), chunk_size):
+        collection_urls.update(get_collection_urls(parent_ids[i:i + chunk_size], index))
+    return collection_urls
 
-    nuxeo_data = resp.json()
-    return nuxeo_data
+def count_collections(parents):
+    '''
+    Count parents per collection, most affected collection first. Parents
+    that aren't in the rikolti index are counted under None.
+    '''
+    counts = {}
+    for parent in parents.values():
+        collection_url = parent.get('collection_url')
+        counts[collection_url] = counts.get(collection_url, 0) + 1
+    return dict(sorted(counts.items(), key=lambda c: c[1], reverse=True))
 
-def main():
+def main(snapshot_file=None, rikolti_index=settings.RIKOLTI_INDEX):
     '''
     Create report listing complex objects in Nuxeo whose children have
     a `hierarchy.pos` field of NULL. Only includes objects with more
     than 1 child.
-    '''
-    complex_obj_no_pos = get_complex_obj_no_pos()
-    if complex_obj_no_pos:
-        parents = {}
 
-        for obj in complex_obj_no_pos:
-            parentid = obj['parentid']
-            if parents.get(parentid):
-                parents.get(parentid)['child_count'] += 1
-            else:
-                parents[parentid] = {"child_count": 1}
+    Reads the hierarchy from `snapshot_file` if given, otherwise exports
+    a new snapshot from the database.
+
+    If RIKOLTI_OPENSEARCH_ENDPOINT is set, each parent is also attributed
+    to its Calisphere collection in `rikolti_index`, and a report of the number of problem
+    parents per collection is written alongside.
+    '''
+    metrics.start()
+    snap = open_snapshot(snapshot_file)
+    with metrics.timed("analyze.ordering"):
+        report = analyze_snapshot(snap)
+    null_count_total = int(report.null_count.sum())
+    if null_count_total:
+        total_parent_count = int(np.count_nonzero(report.null_count))
 
-        total_parent_count = len(parents)
         # we only want a list of parents with more than one child
-        for id in list(parents.keys()):
-            child_count = parents[id]['child_count']
-            if child_count <= 1:
-                del parents[id]
+        parents = {}
+        for i in np.flatnonzero(report.null_count > 1):
+            parents[uuid_str(report.parents[i])] = {
+                "child_count": int(report.null_count[i])
+            }
 
         for id in parents:
-            nuxeo_data = get_nuxeo_data(id)
-            for entry in nuxeo_data['entries']:
+            for entry in get_nuxeo_data(id):
                 parents[id]['path'] = entry['path']
                 parents[id]['title'] = entry['title']
                 parents[id]['type'] = entry['type']
 
+        collection_counts = None
+        if settings.RIKOLTI_OPENSEARCH_ENDPOINT:
+            collection_urls = attribute_collections(parents, rikolti_index)
+            for id in parents:
+                parents[id]['collection_url'] = collection_urls.get(id)
+            collection_counts = count_collections(parents)
+
         version = datetime.now(ZoneInfo("America/Los_Angeles")).strftime('%Y-%m-%dT%H:%M:%S.%Z')
         storage = parse_data_uri(settings.OUTPUT_URI)
         path = storage.path
@@ -154,17 +145,37 @@ def main():
         parent_paths = "\n".join(parent_paths)
         load_object_to_s3(storage.bucket, s3_key, parent_paths)
 
-        print(f"Found {len(complex_obj_no_pos)} total component objects with null pos\n"
+        # write json file of problem parent counts per collection
+        if collection_counts is not None:
+            s3_key = f"{path}/complex_obj_no_order_collections_{version}.json"
+            load_object_to_s3(storage.bucket, s3_key, json.dumps([
+                {"collection_url": c, "count": count}
+                for c, count in collection_counts.items()
+            ]))
+
+        print(f"Found {null_count_total} total component objects with null pos\n"
               f"belonging to {total_parent_count} total parent objects."
               f"Found {len(parents)} problematic parent objects with > 1 component.\n"
               f"Database host: {settings.NUXEO_DB_HOST}\n"
         )
+        if collection_counts is not None:
+            print("Collection URL  Count of complex objs with ordering problem")
+            for c, count in collection_counts.items():
+                print(f"{str(c).ljust(15)} {count}")
     else:
         print(
             "Found zero complex object components with null position.\n"
             f"Database host: {settings.NUXEO_DB_HOST}\n"
         )
+    metrics.finish()
 
 if __name__ == '__main__':
-     main()
-     sys.exit(0)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("snapshot_file", nargs="?",
+        help="snapshot to read instead of exporting a new one")
+    parser.add_argument("--rikolti-index", default=settings.RIKOLTI_INDEX,
+        help="rikolti index to look up collections in "
+             "(default: RIKOLTI_INDEX, or rikolti-stg)")
+    args = parser.parse_args()
+    main(args.snapshot_file, args.rikolti_index)
+    sys.exit(0)
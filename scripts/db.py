@@ -0,0 +1,38 @@
+import psycopg2
+
+import settings
+
+# primarytypes used for complex objects and their components
+COMPLEX_OBJECT_TYPES = (
+    'SampleCustomPicture', 'CustomFile', 'CustomVideo',
+    'CustomAudio', 'CustomThreeD'
+)
+
+COMPLEX_OBJECT_TYPES_SQL = ", ".join(f"'{t}'" for t in COMPLEX_OBJECT_TYPES)
+
+def get_connection():
+    '''
+    Connect to the primary Nuxeo database. Use this for writes.
+    '''
+    return psycopg2.connect(
+        database=settings.NUXEO_DB_NAME,
+        host=settings.NUXEO_DB_HOST,
+        user=settings.NUXEO_DB_USER,
+        password=settings.NUXEO_DB_PASS,
+        port="5432")
+
+def get_read_connection():
+    '''
+    Connect to the read replica given by NUXEO_DB_READ_DSN, falling back to
+    the primary if it isn't set. Use this for detection and snapshot
+    queries, so that they don't compete with Nuxeo's own traffic.
+
+    The session is read only either way. The replica may lag behind the
+    primary, so re-check anything read here before writing.
+    '''
+    if settings.NUXEO_DB_READ_DSN:
+        conn = psycopg2.connect(settings.NUXEO_DB_READ_DSN)
+    else:
+        conn = get_connection()
+    conn.set_session(readonly=True)
+    return conn
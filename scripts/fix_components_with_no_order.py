@@ -1,53 +1,30 @@
-from collections import namedtuple
 from datetime import datetime
 import json
-import requests
 import sys
-from urllib.parse import urlparse
 from zoneinfo import ZoneInfo
 
-import boto3
-import psycopg2
 from psycopg2.extras import RealDictCursor
 
+import clients
+import db
+import metrics
 import settings
+from throttle import create_throttle
+from storage import parse_data_uri, load_object_to_s3
 
-# TODO: if we ever have to run these scripts again, put storage utils in a shared file
-DataStorage = namedtuple(
-    "DateStorage", "uri, store, bucket, path"
-)
-
-def parse_data_uri(data_uri: str):
-    data_loc = urlparse(data_uri)
-    return DataStorage(
-        data_uri, data_loc.scheme, data_loc.netloc, data_loc.path)
-
-def load_object_to_s3(bucket, key, content):
-    s3_client = boto3.client('s3')
-    print(f"Writing s3://{bucket}/{key}")
-    try:
-        s3_client.put_object(
-            ACL='bucket-owner-full-control',
-            Bucket=bucket,
-            Key=key,
-            Body=content)
-    except Exception as e:
-        print(f"ERROR loading to S3: {e}")
-
-    return f"s3://{bucket}/{key}"
-
+@metrics.timed("postgres.get_null_pos_complex_objects")
 def get_null_pos_complex_objects(cursor):
     '''
     Get list of complex object parent ids where at least one child has a hierarchy.pos of NULL
     '''
-    query = """SELECT parentid
+    query = f"""SELECT parentid
     FROM hierarchy
     WHERE parentid in (
         SELECT id FROM hierarchy
-        WHERE primarytype in ('SampleCustomPicture', 'CustomFile', 'CustomVideo', 'CustomAudio', 'CustomThreeD')
+        WHERE primarytype in ({db.COMPLEX_OBJECT_TYPES_SQL})
         AND (istrashed IS NULL OR istrashed = 'f')
     )
-    AND primarytype in ('SampleCustomPicture', 'CustomFile', 'CustomVideo', 'CustomAudio', 'CustomThreeD')
+    AND primarytype in ({db.COMPLEX_OBJECT_TYPES_SQL})
     AND (istrashed IS NULL OR istrashed = 'f')
     AND pos IS NULL"""
 
@@ -56,30 +33,50 @@ def get_null_pos_complex_objects(cursor):
     ids = [result['parentid'] for result in results]
     return list(set(ids))
 
+@metrics.timed("postgres.is_complex_object")
+def is_complex_object(parent_id, cursor):
+    '''
+    Check that a parent is itself an untrashed complex object, and not
+    e.g. a collection folder, whose children never have a pos
+    '''
+    query = (
+        "SELECT 1 "
+        "FROM hierarchy "
+        f"WHERE primarytype in ({db.COMPLEX_OBJECT_TYPES_SQL}) "
+        f"AND id = '{parent_id}' "
+        "AND (istrashed IS NULL OR istrashed = 'f')"
+    )
+    cursor.execute(query)
+    return cursor.fetchone() is not None
+
+@metrics.timed("postgres.get_children")
 def get_children(parent_id, cursor):
     '''
-    Get list of child objects ordered by name
+    Get list of child objects ordered by name, locking them until the
+    transaction ends
 
     Returns a list of dicts, e.g.:
 
     [
-        {'id': '1', 'parentid': '999', 'name': 'page1.tif'},
-        {'id': '2', 'parentid': '999', 'name': 'page2.tif'}
+        {'id': '1', 'parentid': '999', 'name': 'page1.tif', 'pos': None},
+        {'id': '2', 'parentid': '999', 'name': 'page2.tif', 'pos': 0}
     ]
     '''
 
     query = (
-        "SELECT id, parentid, name "
+        "SELECT id, parentid, name, pos "
         "FROM hierarchy "
-        "WHERE primarytype in ('SampleCustomPicture', 'CustomFile', 'CustomVideo', 'CustomAudio', 'CustomThreeD') "
+        f"WHERE primarytype in ({db.COMPLEX_OBJECT_TYPES_SQL}) "
         f"AND parentid = '{parent_id}' "
         "AND (istrashed IS NULL OR istrashed = 'f') "
-        "ORDER BY name"
+        "ORDER BY name "
+        "FOR UPDATE"
     )
     cursor.execute(query)
     results = cursor.fetchall()
     return results
 
+@metrics.timed("postgres.update_pos")
 def update_pos_in_db(id, pos, cursor):
     '''
     Assign hierarchy.pos value
@@ -93,6 +90,40 @@ def update_pos_in_db(id, pos, cursor):
 
     cursor.execute(sql_update)
 
+def fix_children(parent_id, cursor):
+    '''
+    Number the children of a parent by name, starting at 0. Does not commit.
+
+    `cursor` must be on the primary. The parent may have been found on a
+    lagging replica, so the children are re-read and locked on the primary
+    first, and left alone if none of them has a NULL pos any more.
+
+    Returns a list of the updates made, or None if the parent isn't a
+    complex object, in which case it must not be reindexed either.
+    '''
+    if not is_complex_object(parent_id, cursor):
+        print(f"Refusing to fix {parent_id}: not a complex object")
+        metrics.count("refused_parents")
+        return None
+    updates = []
+    children = get_children(parent_id, cursor)
+    if not any(child['pos'] is None for child in children):
+        print(f"Skipping {parent_id}: no children with NULL pos on the primary")
+        metrics.count("skipped_parents")
+        return updates
+    for pos, child in enumerate(children):
+        update_pos_in_db(child['id'], pos, cursor)
+        updates.append({
+            "component_id": child['id'],
+            "component_name": child['name'],
+            "parent_id": parent_id,
+            "pos": pos
+        })
+    metrics.count("parents")
+    metrics.count("rows", len(updates))
+    return updates
+
+@metrics.timed("nuxeo.reindex")
 def reindex_doc_in_elasticsearch(id):
     '''
     Reindex document and its children in ElasticSearch
@@ -102,56 +133,101 @@ def reindex_doc_in_elasticsearch(id):
         'url': url,
         'auth': (settings.NUXEO_API_USER, settings.NUXEO_API_PASS)
     }
-    response = requests.post(**request)
+    response = clients.nuxeo_session().post(**request)
     response.raise_for_status()
 
+def reindex_parents(parent_ids, reindex_failures):
+    '''
+    Reindex committed parents, recording any that fail in
+    `reindex_failures` and carrying on with the rest. Their pos is no
+    longer NULL, so detection won't find them again.
+
+    Returns the ids that were reindexed.
+    '''
+    reindexed = []
+    for id in parent_ids:
+        try:
+            reindex_doc_in_elasticsearch(id)
+        except Exception as e:
+            print(f"ERROR reindexing {id}: {e}")
+            reindex_failures.append({"parent_id": id, "error": str(e)})
+            metrics.count("reindex_failures")
+            continue
+        reindexed.append(id)
+    return reindexed
+
+def fix_parents(parents, conn, cursor, throttle, updates, reindex_failures):
+    '''
+    Fix and reindex a list of parents, committing a batch of parents at
+    a time and pausing between batches as the throttle says.
+
+    The updates of each committed batch are added to `updates`, and
+    parents that couldn't be reindexed to `reindex_failures`, so both are
+    complete up to the point of failure if this raises.
+    '''
+    batch = []
+    batch_updates = []
+    for parent_id in parents:
+        parent_updates = fix_children(parent_id, cursor)
+        if parent_updates is None:
+            continue
+        batch_updates.extend(parent_updates)
+        batch.append(parent_id)
+        if len(batch) < throttle.batch_size:
+            continue
+
+        throttle.commit(conn)
+        updates.extend(batch_updates)
+        reindex_parents(batch, reindex_failures)
+        batch = []
+        batch_updates = []
+
+    if batch:
+        throttle.commit(conn)
+        updates.extend(batch_updates)
+        reindex_parents(batch, reindex_failures)
+
 def main():
     '''
     Fix children of complex objects where at least one of the child docs has a NULL `hierarchy.pos`.
     Update the `hierarchy.pos` field for each child in the database, then reindex the document
     and its children in ElasticSearch.
     '''
-    conn = psycopg2.connect(
-        database=settings.NUXEO_DB_NAME,
-        host=settings.NUXEO_DB_HOST,
-        user=settings.NUXEO_DB_USER,
-        password=settings.NUXEO_DB_PASS,
-        port="5432")
+    metrics.start()
 
+    # find parents on the read replica, if there is one
+    read_conn = db.get_read_connection()
+    read_cursor = read_conn.cursor(cursor_factory=RealDictCursor)
+    parents = get_null_pos_complex_objects(read_cursor)
+    read_cursor.close()
+    read_conn.close()
+
+    conn = db.get_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    parents = get_null_pos_complex_objects(cursor)
     #parents = parents[0:5]
     database_updates = []
-    for parent_id in parents:
-        #print(f"\nParent ID: {parent_id}")
-        children = get_children(parent_id, cursor)
-        #print(f"Num of children: {len(children)}")
-        pos = 0
-        for child in children:
-            #print(f"Updating {child['name']} with pos {pos}")
-            update_pos_in_db(child['id'], pos, cursor)
-            pos += 1
-            database_updates.append({
-                "component_id": child['id'],
-                "component_name": child['name'],
-                "parent_id": parent_id,
-                "pos": pos
-            })
-        conn.commit()
-
-        #print("Reindexing document and children")
-        reindex_doc_in_elasticsearch(parent_id)
-
-    version = datetime.now(ZoneInfo("America/Los_Angeles")).strftime('%Y-%m-%dT%H:%M:%S.%Z')
-    storage = parse_data_uri(settings.OUTPUT_URI)
-    path = storage.path
-    path = path.lstrip('/')
-
-    s3_key = f"{path}/null_order_fix_report_{version}.json"
-    load_object_to_s3(storage.bucket, s3_key, json.dumps(database_updates))
+    reindex_failures = []
+    try:
+        fix_parents(parents, conn, cursor, create_throttle(),
+                    database_updates, reindex_failures)
+    finally:
+        # always report what was committed, even if the run failed
+        version = datetime.now(ZoneInfo("America/Los_Angeles")).strftime('%Y-%m-%dT%H:%M:%S.%Z')
+        storage = parse_data_uri(settings.OUTPUT_URI)
+        path = storage.path
+        path = path.lstrip('/')
+
+        metrics.finish()
+        s3_key = f"{path}/null_order_fix_report_{version}.json"
+        load_object_to_s3(storage.bucket, s3_key, json.dumps({
+            "updates": database_updates,
+            "reindex_failures": reindex_failures,
+            "metrics": metrics.summary()
+        }))
 
     print(
         f"\nUpdated {len(database_updates)} children of {len(parents)} objects\n"
+        f"{len(reindex_failures)} objects failed to reindex\n"
         f"Database host: {settings.NUXEO_DB_HOST}\n"
         f"Nuxeo API endpoint: {settings.NUXEO_API_ENDPOINT}\n"
     )
@@ -0,0 +1,207 @@
+'''
+Latency, throughput and memory metrics for the hot paths of the scripts.
+
+Calls to Postgres, the Nuxeo API, OpenSearch and S3 are wrapped with
+`timed()`, named `<system>.<operation>`, e.g. `postgres.get_children` or
+`nuxeo.reindex`. Work done is counted with `count()`, e.g. `parents`.
+
+    @metrics.timed("nuxeo.reindex")
+    def reindex_doc_in_elasticsearch(id):
+        ...
+
+    with metrics.timed("postgres.commit"):
+        conn.commit()
+
+    metrics.count("parents")
+
+After `start()`, a snapshot of the metrics recorded since the previous
+snapshot is printed to stdout every METRICS_INTERVAL seconds in CloudWatch
+Embedded Metric Format, so the ECS task's log group turns them into
+CloudWatch metrics. `summary()` returns totals for the whole run, for
+adding to a report.
+'''
+from array import array
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+NAMESPACE = "NuxeoComponentOrdering"
+INTERVAL = int(os.environ.get("METRICS_INTERVAL", 60))
+PERCENTILES = (50, 95, 99)
+
+_lock = threading.Lock()
+_latencies = {}
+_counters = {}
+_emitted = {}
+_counted = {}
+_started = time.time()
+_last_snapshot = _started
+_reporter = None
+
+def script_name():
+    return os.path.basename(sys.argv[0]) or "python"
+
+class timed:
+    '''
+    Record the wall time of a block or function call under `name`
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(self.name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+def record(name, seconds):
+    with _lock:
+        samples = _latencies.get(name)
+        if samples is None:
+            samples = _latencies[name] = array('d')
+        samples.append(seconds * 1000)
+
+def count(name, n=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    return {
+        f"p{p}": ordered[min(len(ordered) - 1, len(ordered) * p // 100)]
+        for p in PERCENTILES
+    }
+
+def peak_memory_mb():
+    '''
+    Peak resident set size of the process, and peak memory traced by
+    tracemalloc if it is running
+    '''
+    # ru_maxrss is in kilobytes on linux
+    memory = {"PeakRSS": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if tracemalloc.is_tracing():
+        memory["PeakTraced"] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    return memory
+
+def emf(dimensions, values, units):
+    return json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": NAMESPACE,
+                "Dimensions": [list(dimensions)],
+                "Metrics": [
+                    {"Name": name, "Unit": units[name]} for name in values
+                ]
+            }]
+        },
+        **dimensions,
+        **values
+    })
+
+def snapshot():
+    '''
+    Print metrics recorded since the last snapshot as EMF log lines
+    '''
+    global _last_snapshot
+    script = script_name()
+    with _lock:
+        windows = {}
+        for name, samples in _latencies.items():
+            start = _emitted.get(name, 0)
+            if len(samples) > start:
+                windows[name] = samples[start:]
+                _emitted[name] = len(samples)
+        counters = {
+            name: total - _counted.get(name, 0) for name, total in _counters.items()
+        }
+        _counted.update(_counters)
+        now = time.time()
+        elapsed = max(now - _last_snapshot, 1e-9)
+        _last_snapshot = now
+
+    for name, window in windows.items():
+        values = {**percentiles(window), "Count": len(window)}
+        units = {p: "Milliseconds" for p in values}
+        units["Count"] = "Count"
+        print(emf({"Script": script, "Operation": name}, values, units), flush=True)
+
+    values = peak_memory_mb()
+    units = {name: "Megabytes" for name in values}
+    for name, total in counters.items():
+        values[f"{name}PerSecond"] = total / elapsed
+        units[f"{name}PerSecond"] = "Count/Second"
+    print(emf({"Script": script}, values, units), flush=True)
+
+def summary():
+    '''
+    Totals for the whole run, for adding to a report
+    '''
+    with _lock:
+        latencies = {name: array('d', samples) for name, samples in _latencies.items()}
+        counters = dict(_counters)
+
+    elapsed = time.time() - _started
+    return {
+        "seconds": round(elapsed, 3),
+        "latency_ms": {
+            name: {
+                "count": len(samples),
+                "total": round(sum(samples), 3),
+                **{p: round(v, 3) for p, v in percentiles(samples).items()}
+            }
+            for name, samples in latencies.items()
+        },
+        "counts": counters,
+        "per_second": {
+            name: round(total / max(elapsed, 1e-9), 3)
+            for name, total in counters.items()
+        },
+        "memory_mb": {
+            name: round(value, 1) for name, value in peak_memory_mb().items()
+        },
+    }
+
+def start(interval=INTERVAL):
+    '''
+    Start printing EMF snapshots every `interval` seconds. Set
+    METRICS_TRACEMALLOC=1 to also trace python allocations (slower).
+    '''
+    global _reporter, _started, _last_snapshot
+    if _reporter is not None:
+        return
+    _started = _last_snapshot = time.time()
+    if os.environ.get("METRICS_TRACEMALLOC"):
+        tracemalloc.start()
+
+    stop = threading.Event()
+    def report():
+        while not stop.wait(interval):
+            snapshot()
+    _reporter = threading.Thread(target=report, name="metrics", daemon=True)
+    _reporter.stop = stop
+    _reporter.start()
+
+def finish():
+    '''
+    Stop the periodic snapshots and print a final one
+    '''
+    global _reporter
+    if _reporter is not None:
+        _reporter.stop.set()
+        _reporter = None
+    snapshot()
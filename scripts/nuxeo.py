@@ -0,0 +1,75 @@
+import requests
+
+import clients
+import metrics
+import settings
+
+# nuxeo's default maximum page size
+PAGE_SIZE = 1000
+
+def search_endpoint():
+    return f"{settings.NUXEO_API_ENDPOINT}/search/lang/NXQL/execute"
+
+def basic_auth():
+    return {'auth': (settings.NUXEO_API_USER, settings.NUXEO_API_PASS)}
+
+def token_auth():
+    return {'headers': {"X-Authentication-Token": settings.NUXEO_API_TOKEN}}
+
+def search(query, schemas=(), limit=None, page_size=PAGE_SIZE,
+           endpoint=None, auth=None):
+    '''
+    Lazily yield the documents matching an NXQL query, fetching one page at
+    a time until `isNextPageAvailable` is false or `limit` documents have
+    been yielded.
+
+    Only the given `schemas` are requested via `X-NXDocumentProperties`;
+    the top level fields of each document (`uid`, `title`, `path`, `type`,
+    etc.) are always returned, so most callers don't need any.
+
+    `auth` is either `basic_auth()` or `token_auth()`, defaulting to basic
+    auth. `endpoint` defaults to the NXQL search endpoint.
+    '''
+    auth = auth or basic_auth()
+    headers = {
+        "Accept": "application/json",
+        "Content-Type": "application/json",
+        "X-NXDocumentProperties": ", ".join(schemas),
+        "X-NXRepository": "default",
+        **auth.get('headers', {})
+    }
+    # page offsets are pageSize * currentPageIndex, so the size can't change
+    if limit is not None:
+        page_size = max(1, min(page_size, limit))
+
+    request = {
+        'url': endpoint or search_endpoint(),
+        'headers': headers,
+        'params': {
+            'pageSize': page_size,
+            'currentPageIndex': 0,
+            'query': query
+        },
+        'auth': auth.get('auth')
+    }
+
+    count = 0
+    while True:
+        try:
+            with metrics.timed("nuxeo.search"):
+                resp = clients.nuxeo_session().get(**request)
+                resp.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            print(f"unable to fetch documents from nuxeo: {request['params']}")
+            raise(e)
+
+        page = resp.json()
+        for entry in page['entries']:
+            yield entry
+            count += 1
+            if limit is not None and count >= limit:
+                return
+
+        if not page.get('isNextPageAvailable'):
+            return
+        request['params']['currentPageIndex'] += 1
@@ -0,0 +1,210 @@
+from collections import namedtuple
+from datetime import datetime
+import json
+import os
+import sys
+import tempfile
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+import db
+import snapshot
+import storage
+
+# defect flags, combined per parent in OrderingReport.flags
+NULL_POS = 1
+DUPLICATE_POS = 2
+GAP = 4
+OUT_OF_RANGE = 8
+
+DEFECT_NAMES = {
+    NULL_POS: "null_pos",
+    DUPLICATE_POS: "duplicate_pos",
+    GAP: "gap",
+    OUT_OF_RANGE: "out_of_range",
+}
+
+OrderingReport = namedtuple(
+    "OrderingReport",
+    "parents, child_count, null_count, duplicate_count, out_of_range_count, flags"
+)
+
+def group_codes(keys):
+    '''
+    Assign dense integer codes to keys, numbered in sorted key order.
+
+    Returns (codes, unique keys). 16 byte uuid keys are sorted on their
+    leading 8 bytes, which is several times faster than sorting the
+    void dtype; the full 16 bytes are only compared if those collide.
+    '''
+    if keys.dtype.kind != 'V' or keys.dtype.itemsize != 16:
+        unique, codes = np.unique(keys, return_inverse=True)
+        return codes.reshape(-1), unique
+
+    words = np.ascontiguousarray(keys).view('>u8').reshape(-1, 2)
+    hi = words[:, 0].astype(np.uint64)
+    lo = words[:, 1].astype(np.uint64)
+    order = np.argsort(hi)
+    hi_sorted, lo_sorted = hi[order], lo[order]
+    if np.any((hi_sorted[1:] == hi_sorted[:-1]) & (lo_sorted[1:] != lo_sorted[:-1])):
+        order = np.lexsort((lo, hi))
+        hi_sorted, lo_sorted = hi[order], lo[order]
+
+    new_key = np.empty(len(keys), dtype=bool)
+    new_key[0] = True
+    new_key[1:] = (hi_sorted[1:] != hi_sorted[:-1]) | (lo_sorted[1:] != lo_sorted[:-1])
+    codes = np.empty(len(keys), dtype=np.int64)
+    codes[order] = np.cumsum(new_key) - 1
+    return codes, keys[order[new_key]]
+
+def sort_order(codes, pos, pos_null):
+    '''
+    Order rows by (code, pos) with NULL positions last, using a single
+    int64 sort key when the value ranges allow it
+    '''
+    pos_min = pos[~pos_null].min(initial=0)
+    pos_max = pos[~pos_null].max(initial=0)
+    span = int(pos_max) - int(pos_min) + 2
+    if span * (int(codes.max()) + 1) >= 2**63:
+        return np.lexsort((pos, pos_null, codes))
+
+    rank = np.where(pos_null, span - 1, pos - pos_min)
+    return np.argsort(codes * span + rank)
+
+def analyze_ordering(parents, pos, pos_null=None):
+    '''
+    Check the `pos` values of every parent's children in one vectorized pass.
+
+    `parents` is an array of parent keys (any sortable dtype, e.g. the V16
+    uuid column of a snapshot), `pos` an int array and `pos_null` a bool
+    array marking NULL positions. Rows are sorted by (parent, pos) with
+    NULLs last, and every defect class is computed from the group
+    boundaries of the sorted arrays:
+
+        NULL_POS        at least one child has a NULL pos
+        DUPLICATE_POS   two or more children share a pos
+        GAP             the distinct positions are not 0..n-1
+        OUT_OF_RANGE    a pos is negative or >= the number of children
+
+    Returns an OrderingReport of per-parent arrays.
+    '''
+    parents = np.asarray(parents)
+    pos = np.asarray(pos, dtype=np.int64)
+    if pos_null is None:
+        pos_null = np.zeros(len(pos), dtype=bool)
+    pos_null = np.asarray(pos_null, dtype=bool)
+
+    if len(parents) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return OrderingReport(parents[:0], empty, empty, empty, empty, empty)
+
+    codes, keys = group_codes(parents)
+    order = sort_order(codes, pos, pos_null)
+    group = codes[order]
+    pos = pos[order]
+    pos_null = pos_null[order]
+    valid = ~pos_null
+
+    # group codes are dense and sorted, so boundaries are where they change
+    new_group = np.empty(len(group), dtype=bool)
+    new_group[0] = True
+    np.not_equal(group[1:], group[:-1], out=new_group[1:])
+    starts = np.flatnonzero(new_group)
+    groups = len(starts)
+
+    child_count = np.diff(np.append(starts, len(group)))
+    null_count = np.add.reduceat(pos_null, starts).astype(np.int64)
+    valid_count = child_count - null_count
+
+    repeat = valid[1:] & valid[:-1] & ~new_group[1:] & (pos[1:] == pos[:-1])
+    duplicate_count = np.bincount(group[1:][repeat], minlength=groups)
+
+    out_of_range = valid & ((pos < 0) | (pos >= child_count[group]))
+    out_of_range_count = np.bincount(group[out_of_range], minlength=groups)
+
+    # nulls sort last, so each group's valid positions are a sorted prefix
+    has_valid = valid_count > 0
+    distinct = valid_count - duplicate_count
+    min_pos = pos[starts]
+    max_pos = pos[starts + np.maximum(valid_count - 1, 0)]
+    gap = has_valid & ((min_pos != 0) | (max_pos != distinct - 1))
+
+    flags = (
+        np.where(null_count > 0, NULL_POS, 0)
+        | np.where(duplicate_count > 0, DUPLICATE_POS, 0)
+        | np.where(gap, GAP, 0)
+        | np.where(out_of_range_count > 0, OUT_OF_RANGE, 0)
+    )
+
+    return OrderingReport(
+        keys, child_count, null_count,
+        duplicate_count, out_of_range_count, flags)
+
+def analyze_snapshot(snap):
+    '''
+    Run analyze_ordering over the live components in a snapshot
+    '''
+    components = snap.components()
+    return analyze_ordering(
+        snap.parentid[components],
+        snap.pos[components],
+        snap.pos_null[components]
+    )
+
+def defect_names(flags):
+    return [name for flag, name in DEFECT_NAMES.items() if flags & flag]
+
+def open_snapshot(filename=None):
+    '''
+    Open an existing snapshot file, or export a new one from the database
+
+    A new snapshot is exported to a temporary file, which is deleted as
+    soon as it is mapped; the space is freed when the process exits.
+    '''
+    if filename:
+        return snapshot.Snapshot(filename)
+
+    fd, filename = tempfile.mkstemp(suffix=".snap")
+    os.close(fd)
+    try:
+        conn = db.get_read_connection()
+        cursor = conn.cursor()
+        snapshot.export_snapshot(cursor, filename)
+        cursor.close()
+        conn.close()
+        return snapshot.Snapshot(filename)
+    finally:
+        os.remove(filename)
+
+def main(snapshot_file=None):
+    '''
+    Report every complex object whose components have a NULL, duplicate,
+    gapped or out of range `hierarchy.pos`.
+    '''
+    snap = open_snapshot(snapshot_file)
+    report = analyze_snapshot(snap)
+
+    parents = {}
+    defective = np.flatnonzero(report.flags)
+    for i in defective:
+        parents[snapshot.uuid_str(report.parents[i])] = {
+            "child_count": int(report.child_count[i]),
+            "null_count": int(report.null_count[i]),
+            "duplicate_count": int(report.duplicate_count[i]),
+            "out_of_range_count": int(report.out_of_range_count[i]),
+            "defects": defect_names(report.flags[i])
+        }
+
+    version = datetime.now(ZoneInfo("America/Los_Angeles")).strftime('%Y-%m-%dT%H:%M:%S.%Z')
+    bucket, key = storage.output_key(f"complex_obj_ordering_integrity_{version}.json")
+    storage.load_object_to_s3(bucket, key, json.dumps(parents))
+
+    print(f"Checked {len(report.parents)} parent objects. "
+          f"Found {len(defective)} parent objects with ordering defects.")
+    for flag, name in DEFECT_NAMES.items():
+        print(f"  {name}: {np.count_nonzero(report.flags & flag)}")
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
+    sys.exit(0)
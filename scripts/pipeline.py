@@ -0,0 +1,336 @@
+'''
+Detect, fix, reindex and verify complex objects with NULL component
+positions as a pipeline.
+
+Each stage runs in its own thread and passes parent ids to the next stage
+through a bounded queue, so reindexing the first parents starts while
+later parents are still being renumbered. When a downstream stage falls
+behind (e.g. the Nuxeo reindex API is slow), the queue in front of it
+fills up and the upstream stage blocks until there is room again.
+
+    detect --> fix --> reindex --> verify
+'''
+import argparse
+from datetime import datetime
+import heapq
+import json
+import queue
+import sys
+import threading
+import time
+import traceback
+from zoneinfo import ZoneInfo
+
+from psycopg2.extras import RealDictCursor
+
+import db
+import metrics
+import nuxeo
+import settings
+import storage
+from throttle import create_throttle
+from fix_components_with_no_order import (
+    fix_children, get_null_pos_complex_objects, reindex_parents)
+from ordering_integrity import analyze_ordering
+
+DONE = object()
+QUEUE_SIZE = 50
+
+# the reindex is asynchronous, so give elasticsearch a moment to catch up;
+# a parent is retried VERIFY_DELAY * attempt seconds after each failed check
+VERIFY_ATTEMPTS = 5
+VERIFY_DELAY = 2
+
+class Pipeline:
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.stop = threading.Event()
+        self.errors = []
+        self.threads = []
+        self.stats = {}
+
+    def queue(self):
+        return queue.Queue(maxsize=self.queue_size)
+
+    def put(self, outbox, item):
+        '''
+        Put an item on a queue, blocking while it is full unless the
+        pipeline is stopping
+        '''
+        while not self.stop.is_set():
+            try:
+                outbox.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def items(self, inbox):
+        '''
+        Yield items from a queue until the upstream stage is done
+        '''
+        while not self.stop.is_set():
+            try:
+                item = inbox.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is DONE:
+                return
+            yield item
+
+    def stage(self, name, target, *args):
+        '''
+        Run `target(*args)` in its own thread. The last argument, if it is
+        a queue, is the stage's outbox and always receives DONE.
+        '''
+        outbox = args[-1] if args and isinstance(args[-1], queue.Queue) else None
+
+        def run():
+            start = time.perf_counter()
+            try:
+                count = target(*args)
+            except Exception as e:
+                traceback.print_exc()
+                self.errors.append((name, e))
+                self.stop.set()
+                count = None
+            finally:
+                if outbox is not None:
+                    self.put(outbox, DONE)
+            self.stats[name] = {
+                "parents": count,
+                "seconds": round(time.perf_counter() - start, 3)
+            }
+            print(f"{name} stage finished: {self.stats[name]}")
+
+        thread = threading.Thread(target=run, name=name)
+        thread.start()
+        self.threads.append(thread)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+
+def detect(pipeline, outbox):
+    conn = db.get_read_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    parents = get_null_pos_complex_objects(cursor)
+    cursor.close()
+    conn.close()
+
+    print(f"Found {len(parents)} parents with NULL component positions")
+    for parent_id in parents:
+        if not pipeline.put(outbox, parent_id):
+            break
+    return len(parents)
+
+def fix(pipeline, updates, committed, inbox, outbox):
+    conn = db.get_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    throttle = create_throttle()
+    batch = []
+    # updates only go in the report once their batch is committed
+    batch_updates = []
+    count = 0
+    try:
+        for parent_id in pipeline.items(inbox):
+            parent_updates = fix_children(parent_id, cursor)
+            if parent_updates is None:
+                continue
+            batch_updates.extend(parent_updates)
+            batch.append(parent_id)
+            if len(batch) < throttle.batch_size:
+                continue
+            throttle.commit(conn)
+            updates.extend(batch_updates)
+            committed.extend(batch)
+            batch_updates = []
+            if not all(pipeline.put(outbox, id) for id in batch):
+                break
+            count += len(batch)
+            batch = []
+
+        if batch and not pipeline.stop.is_set():
+            throttle.commit(conn)
+            updates.extend(batch_updates)
+            committed.extend(batch)
+            for id in batch:
+                pipeline.put(outbox, id)
+            count += len(batch)
+    finally:
+        cursor.close()
+        conn.close()
+    return count
+
+def reindex(pipeline, reindex_failures, handled, inbox, outbox):
+    '''
+    Reindex parents as they are committed. Parents that fail to reindex
+    are recorded in `reindex_failures` and not passed on to verify.
+    '''
+    count = 0
+    for parent_id in pipeline.items(inbox):
+        reindexed = reindex_parents([parent_id], reindex_failures)
+        handled.append(parent_id)
+        if not reindexed:
+            continue
+        count += 1
+        if not pipeline.put(outbox, parent_id):
+            break
+    return count
+
+@metrics.timed("postgres.get_db_order")
+def get_db_order(parent_id, cursor):
+    query = (
+        "SELECT id, pos "
+        "FROM hierarchy "
+        f"WHERE primarytype in ({db.COMPLEX_OBJECT_TYPES_SQL}) "
+        f"AND parentid = '{parent_id}' "
+        "AND (istrashed IS NULL OR istrashed = 'f') "
+        "ORDER BY pos"
+    )
+    cursor.execute(query)
+    return cursor.fetchall()
+
+@metrics.timed("nuxeo.get_indexed_order")
+def get_indexed_order(parent_id):
+    '''
+    Get child ids of a parent in `ecm:pos` order from the Nuxeo
+    elasticsearch index
+    '''
+    query = (
+        f"SELECT * FROM {', '.join(db.COMPLEX_OBJECT_TYPES)} "
+        f"WHERE ecm:parentId = '{parent_id}' "
+        "AND ecm:isVersion = 0 "
+        "AND ecm:mixinType != 'HiddenInNavigation' "
+        "AND ecm:isTrashed = 0 "
+        "ORDER BY ecm:pos ASC"
+    )
+    return [entry['uid'] for entry in nuxeo.search(query)]
+
+def verify(pipeline, results, inbox):
+    '''
+    Check that each parent's children now have positions 0..n-1 in the
+    database, and that the Nuxeo index returns them in the same order
+
+    The reindex is asynchronous, so a parent whose index order doesn't
+    match yet is retried later instead of holding up the parents behind it.
+    '''
+    # read from the primary, since a replica may not have the fix yet
+    conn = db.get_connection()
+    conn.autocommit = True
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    # (time due, attempt, parent id, database_ok, child ids in the database)
+    deferred = []
+    upstream_done = False
+    count = 0
+
+    def check_index(attempt, parent_id, db_ok, db_ids):
+        index_ok = get_indexed_order(parent_id) == db_ids
+        if not index_ok and attempt + 1 < VERIFY_ATTEMPTS:
+            due = time.time() + VERIFY_DELAY * (attempt + 1)
+            heapq.heappush(deferred, (due, attempt + 1, parent_id, db_ok, db_ids))
+            return 0
+        results.append({
+            "parent_id": parent_id,
+            "database_ok": db_ok,
+            "index_ok": index_ok,
+        })
+        return 1
+
+    try:
+        while not pipeline.stop.is_set() and not (upstream_done and not deferred):
+            if deferred and deferred[0][0] <= time.time():
+                _, *retry = heapq.heappop(deferred)
+                count += check_index(*retry)
+                continue
+
+            timeout = 1
+            if deferred:
+                timeout = max(0, min(timeout, deferred[0][0] - time.time()))
+            if upstream_done:
+                time.sleep(timeout)
+                continue
+            try:
+                parent_id = inbox.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if parent_id is DONE:
+                upstream_done = True
+                continue
+
+            rows = get_db_order(parent_id, cursor)
+            report = analyze_ordering(
+                [parent_id] * len(rows),
+                [row['pos'] or 0 for row in rows],
+                [row['pos'] is None for row in rows]
+            )
+            db_ok = not report.flags.any()
+            count += check_index(0, parent_id, db_ok, [row['id'] for row in rows])
+    finally:
+        cursor.close()
+        conn.close()
+    return count
+
+def main(queue_size=QUEUE_SIZE):
+    '''
+    Fix children of complex objects where at least one of the child docs
+    has a NULL `hierarchy.pos`, reindex them and verify the result, with
+    each step running concurrently.
+    '''
+    pipeline = Pipeline(queue_size)
+    updates = []
+    committed = []
+    reindex_failures = []
+    # parents the reindex stage got to, whether or not they reindexed
+    handled = []
+    verified = []
+
+    to_fix = pipeline.queue()
+    to_reindex = pipeline.queue()
+    to_verify = pipeline.queue()
+
+    metrics.start()
+    start = time.perf_counter()
+    pipeline.stage("detect", detect, pipeline, to_fix)
+    pipeline.stage("fix", fix, pipeline, updates, committed, to_fix, to_reindex)
+    pipeline.stage("reindex", reindex, pipeline, reindex_failures, handled,
+                   to_reindex, to_verify)
+    pipeline.stage("verify", verify, pipeline, verified, to_verify)
+    pipeline.join()
+    elapsed = time.perf_counter() - start
+    metrics.finish()
+
+    failed = [v for v in verified if not (v['database_ok'] and v['index_ok'])]
+    # committed, but the reindex stage stopped before it got to them
+    not_reindexed = [id for id in committed if id not in set(handled)]
+
+    version = datetime.now(ZoneInfo("America/Los_Angeles")).strftime('%Y-%m-%dT%H:%M:%S.%Z')
+    bucket, key = storage.output_key(f"null_order_pipeline_report_{version}.json")
+    storage.load_object_to_s3(bucket, key, json.dumps({
+        "stages": pipeline.stats,
+        "seconds": round(elapsed, 3),
+        "errors": [f"{name}: {e}" for name, e in pipeline.errors],
+        "updates": updates,
+        "reindex_failures": reindex_failures,
+        "not_reindexed": not_reindexed,
+        "verification": verified,
+        "metrics": metrics.summary(),
+    }))
+
+    print(
+        f"\nUpdated {len(updates)} children of {len(verified)} verified objects "
+        f"in {elapsed:.1f} seconds\n"
+        f"{len(failed)} objects failed verification\n"
+        f"{len(reindex_failures) + len(not_reindexed)} objects were fixed but not reindexed\n"
+        f"Database host: {settings.NUXEO_DB_HOST}\n"
+        f"Nuxeo API endpoint: {settings.NUXEO_API_ENDPOINT}\n"
+    )
+    return 1 if pipeline.errors else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+        help="maximum number of parents waiting between two stages")
+    args = parser.parse_args()
+    sys.exit(main(args.queue_size))
@@ -1,18 +1,9 @@
 import os
 
-from boto3 import Session
-from opensearchpy import AWSV4SignerAuth
-
-def get_aws_auth():
-    credentials = Session().get_credentials()
-    if not credentials:
-        return False
-    return AWSV4SignerAuth(
-        credentials, os.environ.get("AWS_REGION", "us-west-2"))
-
 OUTPUT_URI = os.environ.get("OUTPUT_URI")
 
 RIKOLTI_OPENSEARCH_ENDPOINT = os.environ.get("RIKOLTI_OPENSEARCH_ENDPOINT")
+RIKOLTI_INDEX = os.environ.get("RIKOLTI_INDEX") or "rikolti-stg"
 NUXEO_ELASTICSEARCH_ENDPOINT = os.environ.get("NUXEO_ELASTICSEARCH_ENDPOINT")
 
 NUXEO_API_ENDPOINT = os.environ.get("NUXEO_API_ENDPOINT")
@@ -23,4 +14,15 @@ NUXEO_API_PASS = os.environ.get("NUXEO_API_PASS")
 NUXEO_DB_NAME = os.environ.get("NUXEO_DB_NAME")
 NUXEO_DB_HOST = os.environ.get("NUXEO_DB_HOST")
 NUXEO_DB_USER = os.environ.get("NUXEO_DB_USER")
-NUXEO_DB_PASS = os.environ.get("NUXEO_DB_PASS")
\ No newline at end of file
+NUXEO_DB_PASS = os.environ.get("NUXEO_DB_PASS")
+# optional libpq connection string for a read replica, used for read-only queries
+NUXEO_DB_READ_DSN = os.environ.get("NUXEO_DB_READ_DSN") or None
+
+# adaptive throttling of database writes, see throttle.py
+THROTTLE_TARGET_COMMIT_MS = float(os.environ.get("THROTTLE_TARGET_COMMIT_MS", 200))
+THROTTLE_MAX_LOCK_WAITS = int(os.environ.get("THROTTLE_MAX_LOCK_WAITS", 5))
+THROTTLE_MAX_REPLICA_LAG = float(os.environ.get("THROTTLE_MAX_REPLICA_LAG", 5))
+THROTTLE_MAX_BATCH_SIZE = int(os.environ.get("THROTTLE_MAX_BATCH_SIZE", 50))
+THROTTLE_MAX_PAUSE = float(os.environ.get("THROTTLE_MAX_PAUSE", 30))
+THROTTLE_SAMPLE_INTERVAL = float(os.environ.get("THROTTLE_SAMPLE_INTERVAL", 5))
+THROTTLE_SAMPLE_DB = os.environ.get("THROTTLE_SAMPLE_DB", "true").lower() == "true"
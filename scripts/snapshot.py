@@ -0,0 +1,290 @@
+'''
+Columnar snapshot of complex object rows in the Nuxeo `hierarchy` table.
+
+The rows are streamed out of postgres with `COPY ... TO STDOUT` and written
+to a single file that can be memory-mapped, so that the detection, duplicate
+and comparison analyses can be run repeatedly without re-querying the
+database or holding a dict per row in memory.
+
+File layout:
+
+    MAGIC (8 bytes)
+    header length (8 bytes, little-endian uint64)
+    header (json)
+    column data, each column aligned to ALIGNMENT bytes
+
+Columns:
+
+    id              V16     uuid as 16 raw bytes
+    parentid        V16     uuid as 16 raw bytes; all zeros when NULL
+    pos             <i8     0 when NULL
+    pos_null        bool
+    name            <u4     code into the name dictionary
+    name_offsets    <u8     offsets into name_data for each dictionary entry
+    name_data       u1      utf-8 encoded dictionary entries
+    primarytype     <u1     index into header['primarytypes']
+    istrashed       bool    NULL is stored as False, matching the
+                            `istrashed IS NULL OR istrashed = 'f'` filter
+'''
+
+from array import array
+from datetime import datetime
+import json
+import os
+import re
+import sys
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+import db
+import metrics
+import storage
+
+MAGIC = b"NXHSNAP1"
+ALIGNMENT = 64
+NULL_UUID = bytes(16)
+
+SNAPSHOT_QUERY = (
+    "COPY ("
+    "SELECT id, parentid, pos, name, primarytype, istrashed "
+    "FROM hierarchy "
+    f"WHERE primarytype in ({db.COMPLEX_OBJECT_TYPES_SQL})"
+    ") TO STDOUT"
+)
+
+COPY_ESCAPES = {
+    'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r',
+    't': '\t', 'v': '\v', '\\': '\\'
+}
+COPY_ESCAPE_RE = re.compile(r"\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)")
+
+def unescape_copy_text(value):
+    '''
+    Decode a field in postgres COPY text format
+    '''
+    def replace(match):
+        escape = match.group(1)
+        if escape[0] == 'x' and len(escape) > 1:
+            return chr(int(escape[1:], 16))
+        if escape[0] in '01234567':
+            return chr(int(escape, 8))
+        return COPY_ESCAPES.get(escape, escape)
+    return COPY_ESCAPE_RE.sub(replace, value)
+
+def aligned(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+def uuid_bytes(value):
+    return bytes.fromhex(value.replace('-', ''))
+
+def uuid_str(value):
+    '''
+    Format a 16 byte uuid (bytes or numpy void) the way nuxeo stores it
+    '''
+    h = bytes(value).hex()
+    return f"{h[0:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:32]}"
+
+
+class SnapshotWriter:
+    '''
+    File-like sink for `cursor.copy_expert`. Parses COPY text rows as
+    they arrive and accumulates them in compact column buffers.
+    '''
+    def __init__(self):
+        self.ids = bytearray()
+        self.parentids = bytearray()
+        self.pos = array('q')
+        self.pos_null = bytearray()
+        self.name_codes = array('I')
+        self.name_lookup = {}
+        self.primarytype_codes = bytearray()
+        self.primarytypes = {}
+        self.istrashed = bytearray()
+        self.rows = 0
+        self._partial = b""
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self.add_row(line.decode('utf-8').split("\t"))
+        return len(data)
+
+    def add_row(self, fields):
+        id, parentid, pos, name, primarytype, istrashed = fields
+
+        self.ids += uuid_bytes(id)
+        self.parentids += NULL_UUID if parentid == r"\N" else uuid_bytes(parentid)
+
+        if pos == r"\N":
+            self.pos.append(0)
+            self.pos_null.append(1)
+        else:
+            self.pos.append(int(pos))
+            self.pos_null.append(0)
+
+        if name == r"\N":
+            name = ""
+        elif "\\" in name:
+            name = unescape_copy_text(name)
+        code = self.name_lookup.get(name)
+        if code is None:
+            code = self.name_lookup[name] = len(self.name_lookup)
+        self.name_codes.append(code)
+
+        code = self.primarytypes.get(primarytype)
+        if code is None:
+            code = self.primarytypes[primarytype] = len(self.primarytypes)
+        self.primarytype_codes.append(code)
+
+        self.istrashed.append(1 if istrashed == 't' else 0)
+        self.rows += 1
+
+    def columns(self):
+        names = [n.encode('utf-8') for n in self.name_lookup]
+        name_offsets = np.zeros(len(names) + 1, dtype='<u8')
+        np.cumsum([len(n) for n in names], out=name_offsets[1:])
+
+        return {
+            "id": np.frombuffer(self.ids, dtype='V16'),
+            "parentid": np.frombuffer(self.parentids, dtype='V16'),
+            "pos": np.frombuffer(self.pos, dtype=np.int64).astype('<i8'),
+            "pos_null": np.frombuffer(self.pos_null, dtype=np.bool_),
+            "name": np.frombuffer(self.name_codes, dtype=np.uint32).astype('<u4'),
+            "name_offsets": name_offsets,
+            "name_data": np.frombuffer(b"".join(names), dtype=np.uint8),
+            "primarytype": np.frombuffer(self.primarytype_codes, dtype='<u1'),
+            "istrashed": np.frombuffer(self.istrashed, dtype=np.bool_),
+        }
+
+    def save(self, filename):
+        if self._partial:
+            raise ValueError("COPY stream ended in the middle of a row")
+
+        columns = self.columns()
+        header = {
+            "rows": self.rows,
+            "created": datetime.now(ZoneInfo("America/Los_Angeles")).isoformat(),
+            "primarytypes": list(self.primarytypes),
+            "columns": {}
+        }
+        offset = 0
+        for name, column in columns.items():
+            header["columns"][name] = {
+                "dtype": column.dtype.str,
+                "offset": offset,
+                "length": len(column)
+            }
+            offset += aligned(column.nbytes)
+
+        offsets = [c["offset"] for c in header["columns"].values()]
+        header = json.dumps(header).encode('utf-8')
+        data_start = aligned(len(MAGIC) + 8 + len(header))
+
+        with open(filename, "wb") as f:
+            f.write(MAGIC)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            for column_offset, column in zip(offsets, columns.values()):
+                f.seek(data_start + column_offset)
+                f.write(column.data)
+            f.truncate(data_start + offset)
+
+        return filename
+
+
+class Snapshot:
+    '''
+    Read-only, memory-mapped view of a snapshot file.
+
+    Columns are exposed as numpy arrays backed by the file, so opening
+    a snapshot is cheap and pages are only read as they are used.
+    '''
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{filename} is not a hierarchy snapshot")
+            header_length = int.from_bytes(f.read(8), "little")
+            self.header = json.loads(f.read(header_length))
+
+        data_start = aligned(len(MAGIC) + 8 + header_length)
+        self.filename = filename
+        self.rows = self.header["rows"]
+        self.primarytypes = self.header["primarytypes"]
+        self._buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+
+        for name, column in self.header["columns"].items():
+            dtype = np.dtype(column["dtype"])
+            start = data_start + column["offset"]
+            end = start + column["length"] * dtype.itemsize
+            setattr(self, name, self._buffer[start:end].view(dtype))
+
+    def name_of(self, code):
+        start, end = self.name_offsets[code], self.name_offsets[code + 1]
+        return self.name_data[start:end].tobytes().decode('utf-8')
+
+    def row(self, i):
+        '''
+        Return a single row as a dict, in the same shape as the
+        original `json_agg` output
+        '''
+        return {
+            "id": uuid_str(self.id[i]),
+            "parentid": None if bytes(self.parentid[i]) == NULL_UUID
+                else uuid_str(self.parentid[i]),
+            "pos": None if self.pos_null[i] else int(self.pos[i]),
+            "name": self.name_of(self.name[i]),
+            "primarytype": self.primarytypes[self.primarytype[i]],
+            "istrashed": bool(self.istrashed[i])
+        }
+
+    def components(self):
+        '''
+        Boolean mask of rows that are live components of a live complex
+        object, i.e. the rows that the detection queries look at
+        '''
+        live = ~self.istrashed
+        live_ids = np.sort(self.id[live])
+        index = np.searchsorted(live_ids, self.parentid)
+        index[index == len(live_ids)] = 0
+        has_live_parent = (live_ids[index] == self.parentid) if len(live_ids) \
+            else np.zeros(self.rows, dtype=bool)
+        return live & has_live_parent
+
+
+def export_snapshot(cursor, filename):
+    '''
+    Stream complex object hierarchy rows into a snapshot file
+    '''
+    writer = SnapshotWriter()
+    with metrics.timed("postgres.copy_snapshot"):
+        cursor.copy_expert(SNAPSHOT_QUERY, writer)
+    writer.save(filename)
+    metrics.count("rows", writer.rows)
+    print(f"Wrote {writer.rows} rows to {filename} ({os.path.getsize(filename)} bytes)")
+    return filename
+
+def main():
+    '''
+    Export a columnar snapshot of complex object rows in the `hierarchy`
+    table and upload it to S3.
+    '''
+    version = datetime.now(ZoneInfo("America/Los_Angeles")).strftime('%Y-%m-%dT%H:%M:%S.%Z')
+    filename = sys.argv[1] if len(sys.argv) > 1 else f"hierarchy_{version}.snap"
+
+    conn = db.get_read_connection()
+    cursor = conn.cursor()
+    export_snapshot(cursor, filename)
+    cursor.close()
+    conn.close()
+
+    if len(sys.argv) == 1:
+        bucket, key = storage.output_key(os.path.basename(filename))
+        storage.load_file_to_s3(bucket, key, filename)
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
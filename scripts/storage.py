@@ -0,0 +1,55 @@
+from collections import namedtuple
+from urllib.parse import urlparse
+
+import clients
+import metrics
+import settings
+
+DataStorage = namedtuple(
+    "DateStorage", "uri, store, bucket, path"
+)
+
+def parse_data_uri(data_uri: str):
+    data_loc = urlparse(data_uri)
+    return DataStorage(
+        data_uri, data_loc.scheme, data_loc.netloc, data_loc.path)
+
+
+@metrics.timed("s3.put_object")
+def load_object_to_s3(bucket, key, content):
+    s3_client = clients.boto3_client('s3')
+    print(f"Writing s3://{bucket}/{key}")
+    try:
+        s3_client.put_object(
+            ACL='bucket-owner-full-control',
+            Bucket=bucket,
+            Key=key,
+            Body=content)
+    except Exception as e:
+        print(f"ERROR loading to S3: {e}")
+
+    return f"s3://{bucket}/{key}"
+
+@metrics.timed("s3.upload_file")
+def load_file_to_s3(bucket, key, filename):
+    '''
+    Upload a local file to S3 without reading it into memory
+    '''
+    s3_client = clients.boto3_client('s3')
+    print(f"Writing s3://{bucket}/{key}")
+    try:
+        s3_client.upload_file(
+            filename, bucket, key,
+            ExtraArgs={'ACL': 'bucket-owner-full-control'})
+    except Exception as e:
+        print(f"ERROR loading to S3: {e}")
+
+    return f"s3://{bucket}/{key}"
+
+def output_key(name):
+    '''
+    Return (bucket, key) for a report file under settings.OUTPUT_URI
+    '''
+    storage = parse_data_uri(settings.OUTPUT_URI)
+    path = storage.path.lstrip('/')
+    return storage.bucket, f"{path}/{name}"
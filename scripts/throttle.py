@@ -0,0 +1,125 @@
+'''
+Adaptive throttling for writes to the live Nuxeo database.
+
+The fix job commits a batch of parents at a time. After each commit,
+AdaptiveThrottle looks at how long the commit took and, every
+THROTTLE_SAMPLE_INTERVAL seconds, optionally samples `pg_stat_activity`
+for sessions waiting on locks and `pg_stat_replication` for replica lag.
+
+If everything is under target, the batch grows by one parent and the
+pause between batches is halved. If anything is over target, the batch
+is halved and the pause doubled (additive increase, multiplicative
+decrease), so the job backs off quickly when Nuxeo is busy and speeds up
+again slowly when it isn't.
+'''
+import time
+
+import db
+import metrics
+import settings
+
+MIN_PAUSE = 0.05
+
+class AdaptiveThrottle:
+    def __init__(self, monitor_cursor=None,
+                 target_commit_ms=settings.THROTTLE_TARGET_COMMIT_MS,
+                 max_lock_waits=settings.THROTTLE_MAX_LOCK_WAITS,
+                 max_replica_lag=settings.THROTTLE_MAX_REPLICA_LAG,
+                 max_batch_size=settings.THROTTLE_MAX_BATCH_SIZE,
+                 max_pause=settings.THROTTLE_MAX_PAUSE,
+                 sample_interval=settings.THROTTLE_SAMPLE_INTERVAL):
+        '''
+        `monitor_cursor` should be on a separate autocommit connection. If
+        it is None, only commit latency is used.
+        '''
+        self.monitor_cursor = monitor_cursor
+        self.target_commit_ms = target_commit_ms
+        self.max_lock_waits = max_lock_waits
+        self.max_replica_lag = max_replica_lag
+        self.max_batch_size = max_batch_size
+        self.max_pause = max_pause
+        self.sample_interval = sample_interval
+
+        self.batch_size = 1
+        self.pause = 0
+        self.last_sample = 0
+        self.lock_waits = 0
+        self.replica_lag = 0
+
+    def sample_database(self):
+        '''
+        Count sessions waiting on locks and get the worst replica lag,
+        at most once every sample_interval seconds
+        '''
+        if not self.monitor_cursor:
+            return
+        if time.time() - self.last_sample < self.sample_interval:
+            return
+        self.last_sample = time.time()
+
+        try:
+            with metrics.timed("postgres.throttle_sample"):
+                self.monitor_cursor.execute(
+                    "SELECT count(*) FROM pg_stat_activity "
+                    "WHERE wait_event_type = 'Lock'"
+                )
+                self.lock_waits = self.monitor_cursor.fetchone()[0]
+                self.monitor_cursor.execute(
+                    "SELECT coalesce(max(extract(epoch FROM replay_lag)), 0) "
+                    "FROM pg_stat_replication"
+                )
+                self.replica_lag = float(self.monitor_cursor.fetchone()[0])
+        except Exception as e:
+            print(f"Unable to sample database activity, using commit latency only: {e}")
+            self.monitor_cursor = None
+
+    def overloaded(self, commit_ms):
+        return (
+            commit_ms > self.target_commit_ms
+            or self.lock_waits > self.max_lock_waits
+            or self.replica_lag > self.max_replica_lag
+        )
+
+    def after_commit(self, commit_seconds):
+        '''
+        Adjust the batch size and pause for the commit that just finished,
+        then sleep for the pause
+        '''
+        commit_ms = commit_seconds * 1000
+        self.sample_database()
+
+        if self.overloaded(commit_ms):
+            self.batch_size = max(1, self.batch_size // 2)
+            self.pause = min(self.max_pause, max(self.pause * 2, MIN_PAUSE))
+            print(
+                f"Throttling: commit {commit_ms:.0f} ms, "
+                f"{self.lock_waits} lock waits, replica lag {self.replica_lag:.1f} s; "
+                f"batch size {self.batch_size}, pause {self.pause:.2f} s"
+            )
+        else:
+            self.batch_size = min(self.max_batch_size, self.batch_size + 1)
+            self.pause = self.pause / 2 if self.pause / 2 >= MIN_PAUSE else 0
+
+        if self.pause:
+            time.sleep(self.pause)
+
+    def commit(self, conn):
+        '''
+        Commit, time it and throttle
+        '''
+        start = time.perf_counter()
+        with metrics.timed("postgres.commit"):
+            conn.commit()
+        self.after_commit(time.perf_counter() - start)
+
+def create_throttle():
+    '''
+    Return an AdaptiveThrottle, with its own monitoring connection if
+    THROTTLE_SAMPLE_DB is set
+    '''
+    monitor_cursor = None
+    if settings.THROTTLE_SAMPLE_DB:
+        conn = db.get_connection()
+        conn.autocommit = True
+        monitor_cursor = conn.cursor()
+    return AdaptiveThrottle(monitor_cursor)
@@ -0,0 +1,288 @@
+'''
+Watch for components that get a NULL `hierarchy.pos` and repair their
+parents as soon as things settle down, instead of re-running the full
+detection and fix job.
+
+There are two ways of finding newly broken parents:
+
+poll (default)
+    Every --interval seconds, count NULL pos components per parent. The
+    partial index created by `--install` covers only complex object rows
+    with a NULL pos, so the poll reads those rows (and looks up their
+    parents) instead of scanning `hierarchy`. Runs on the read replica if
+    NUXEO_DB_READ_DSN is set.
+
+notify
+    `--install` adds a trigger to `hierarchy` that records every component
+    that gets a NULL pos in the component_order_changes table and sends a
+    NOTIFY. The watcher LISTENs on the primary, and reads the change table
+    past its watermark (the last change id it has seen) when woken up.
+    Processed changes are deleted, so a restarted watcher picks up where
+    the last one stopped.
+
+A parent is only fixed once it has gone --debounce seconds without a new
+change, so a bulk move of many components into the same parent is fixed
+once, after the move has finished.
+'''
+import argparse
+from datetime import datetime
+import json
+import select
+import signal
+import sys
+import time
+from zoneinfo import ZoneInfo
+
+from psycopg2.extras import RealDictCursor
+
+import db
+import metrics
+import settings
+import storage
+from fix_components_with_no_order import fix_parents
+from throttle import create_throttle
+
+POLL_INTERVAL = 10
+DEBOUNCE = 30
+CHANNEL = "component_order_changes"
+
+# pos is NULL for every document in an unordered folder and for complex
+# property rows, so the index has to be limited to complex object types
+POLL_INSTALL_SQL = (
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS hierarchy_null_pos_idx "
+    "ON hierarchy (parentid) "
+    f"WHERE pos IS NULL AND primarytype in ({db.COMPLEX_OBJECT_TYPES_SQL})"
+)
+
+NOTIFY_INSTALL_SQL = f"""
+CREATE TABLE IF NOT EXISTS component_order_changes (
+    id bigserial PRIMARY KEY,
+    parentid varchar(36) NOT NULL,
+    changed_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- only components of a live complex object count; objects in collection
+-- folders never have a pos
+CREATE OR REPLACE FUNCTION component_order_changed() RETURNS trigger AS $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM hierarchy p
+        WHERE p.id = NEW.parentid
+        AND p.primarytype in ({db.COMPLEX_OBJECT_TYPES_SQL})
+        AND (p.istrashed IS NULL OR p.istrashed = 'f')
+    ) THEN
+        INSERT INTO component_order_changes (parentid) VALUES (NEW.parentid);
+        PERFORM pg_notify('{CHANNEL}', NEW.parentid);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS component_order_changed ON hierarchy;
+CREATE TRIGGER component_order_changed
+AFTER INSERT OR UPDATE OF pos, parentid ON hierarchy
+FOR EACH ROW
+WHEN (NEW.pos IS NULL AND NEW.parentid IS NOT NULL
+      AND NEW.primarytype in ({db.COMPLEX_OBJECT_TYPES_SQL})
+      AND (NEW.istrashed IS NULL OR NEW.istrashed = 'f'))
+EXECUTE PROCEDURE component_order_changed();
+"""
+
+class PollSource:
+    '''
+    Finds parents whose count of NULL pos components has changed since
+    the previous poll
+    '''
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self.conn = db.get_read_connection()
+        self.conn.autocommit = True
+        self.cursor = self.conn.cursor()
+        self.counts = {}
+        self.next_poll = 0
+
+    @metrics.timed("postgres.poll_null_pos")
+    def null_pos_counts(self):
+        query = (
+            "SELECT c.parentid, count(*) "
+            "FROM hierarchy c "
+            "JOIN hierarchy p ON p.id = c.parentid "
+            "WHERE c.pos IS NULL "
+            f"AND c.primarytype in ({db.COMPLEX_OBJECT_TYPES_SQL}) "
+            "AND (c.istrashed IS NULL OR c.istrashed = 'f') "
+            f"AND p.primarytype in ({db.COMPLEX_OBJECT_TYPES_SQL}) "
+            "AND (p.istrashed IS NULL OR p.istrashed = 'f') "
+            "GROUP BY c.parentid"
+        )
+        self.cursor.execute(query)
+        return dict(self.cursor.fetchall())
+
+    def changed_parents(self, timeout):
+        time.sleep(max(0, min(timeout, self.next_poll - time.time())))
+        if time.time() < self.next_poll:
+            return []
+        self.next_poll = time.time() + self.interval
+
+        counts = self.null_pos_counts()
+        changed = [
+            parent_id for parent_id, count in counts.items()
+            if self.counts.get(parent_id) != count
+        ]
+        self.counts = counts
+        return changed
+
+    def done(self, parent_ids):
+        pass
+
+    def install(self):
+        conn = db.get_connection()
+        conn.autocommit = True
+        conn.cursor().execute(POLL_INSTALL_SQL)
+        conn.close()
+
+
+class NotifySource:
+    '''
+    Reads parents from the trigger-fed change table, waking up on NOTIFY
+    '''
+    def __init__(self):
+        # notifications aren't sent to replicas, so this has to be the primary
+        self.conn = db.get_connection()
+        self.conn.autocommit = True
+        self.cursor = self.conn.cursor()
+        self.watermark = 0
+
+    def listen(self):
+        self.cursor.execute(f"LISTEN {CHANNEL}")
+
+    @metrics.timed("postgres.read_changes")
+    def read_changes(self):
+        self.cursor.execute(
+            "SELECT id, parentid FROM component_order_changes "
+            "WHERE id > %s ORDER BY id",
+            (self.watermark,)
+        )
+        rows = self.cursor.fetchall()
+        if rows:
+            self.watermark = rows[-1][0]
+        return [parentid for _, parentid in rows]
+
+    def changed_parents(self, timeout):
+        if not self.conn.notifies:
+            select.select([self.conn], [], [], timeout)
+            self.conn.poll()
+        # the payloads are only a wake up call; the table is the record
+        self.conn.notifies.clear()
+        return self.read_changes()
+
+    def done(self, parent_ids):
+        self.cursor.execute(
+            "DELETE FROM component_order_changes "
+            "WHERE parentid = ANY(%s) AND id <= %s",
+            (list(parent_ids), self.watermark)
+        )
+
+    def install(self):
+        self.cursor.execute(NOTIFY_INSTALL_SQL)
+
+
+def repair(parent_ids, conn, cursor, throttle):
+    '''
+    Fix and reindex parents, and write a report of the updates to S3
+
+    Returns the ids of parents that were fixed but couldn't be reindexed
+    '''
+    updates = []
+    reindex_failures = []
+    try:
+        fix_parents(parent_ids, conn, cursor, throttle, updates, reindex_failures)
+    finally:
+        print(f"Updated {len(updates)} children of {len(parent_ids)} objects")
+        if updates or reindex_failures:
+            version = datetime.now(ZoneInfo("America/Los_Angeles")).strftime('%Y-%m-%dT%H:%M:%S.%Z')
+            bucket, key = storage.output_key(f"null_order_watch_fix_report_{version}.json")
+            storage.load_object_to_s3(bucket, key, json.dumps({
+                "updates": updates,
+                "reindex_failures": reindex_failures
+            }))
+    return [failure['parent_id'] for failure in reindex_failures]
+
+def watch(source, debounce=DEBOUNCE, max_wait=POLL_INTERVAL):
+    '''
+    Repair parents reported by `source` once they have been quiet for
+    `debounce` seconds. Runs until interrupted.
+    '''
+    conn = db.get_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    throttle = create_throttle()
+
+    # parent id -> time of the last change seen for it
+    pending = {}
+    while True:
+        now = time.time()
+        timeout = max_wait
+        if pending:
+            timeout = max(0, min(timeout, min(pending.values()) + debounce - now))
+
+        for parent_id in source.changed_parents(timeout):
+            pending[parent_id] = time.time()
+            metrics.count("changes")
+
+        now = time.time()
+        ready = [p for p, changed in pending.items() if now - changed >= debounce]
+        if not ready:
+            continue
+        try:
+            failed = set(repair(ready, conn, cursor, throttle))
+        except Exception as e:
+            # keep watching, and retry these parents after another debounce
+            print(f"ERROR repairing {len(ready)} objects, will retry: {e}")
+            conn.rollback()
+            for parent_id in ready:
+                pending[parent_id] = time.time()
+            continue
+        # parents that failed to reindex are retried; their children are
+        # already fixed, so the retry only reindexes them
+        source.done([p for p in ready if p not in failed])
+        for parent_id in ready:
+            if parent_id in failed:
+                pending[parent_id] = time.time()
+            else:
+                del pending[parent_id]
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Continuously repair complex objects whose components get a NULL pos")
+    parser.add_argument("--mode", choices=["poll", "notify"], default="poll")
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL,
+        help="seconds between polls (poll mode), or between checks of "
+             "the change table when no NOTIFY arrives (notify mode)")
+    parser.add_argument("--debounce", type=float, default=DEBOUNCE,
+        help="seconds a parent must go without changes before it is fixed")
+    parser.add_argument("--install", action="store_true",
+        help="create the partial index (poll) or change table and trigger "
+             "(notify) on the primary database, then start watching")
+    args = parser.parse_args()
+
+    source = PollSource(args.interval) if args.mode == "poll" else NotifySource()
+    if args.install:
+        source.install()
+    if args.mode == "notify":
+        source.listen()
+
+    # ECS stops tasks with SIGTERM
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    metrics.start()
+    print(
+        f"Watching for NULL pos components ({args.mode} mode, "
+        f"debounce {args.debounce} s)\n"
+        f"Database host: {settings.NUXEO_DB_HOST}\n"
+    )
+    try:
+        watch(source, args.debounce, args.interval)
+    finally:
+        metrics.finish()
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)